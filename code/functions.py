@@ -6,14 +6,76 @@ This code is licensed under under the [BSD 3-clause]
 See the file `LICENSE.md`
 '''
 
+import math
+import threading
 import numpy as np
 from fatiando import mesher, gridder
 from fatiando.gravmag import prism, sphere, polyprism
-from fatiando.utils import ang2vec, vec2ang
+from fatiando.utils import ang2vec
 from fatiando.vis import mpl
 from fatiando.constants import CM, T2NT
 
-def point2grid(x, y, effective_area, ns, z = None):
+try:
+    from numba import njit, prange, threading_layer, config as numba_config
+except ImportError:
+    njit = None
+
+# offsets of the small grids, memoized by _offsets
+_OFFSETS = {}
+
+# scratch arrays reused across calls by _scratch, one pool per thread
+_BUF_POOL = threading.local()
+
+def _scratch(name, size):
+    '''
+    Returns a float64 numpy array 1D with size elements from the pool of
+    the current thread. The array is reused by the next call with the
+    same name, so its content is only valid until then.
+    '''
+    
+    buf = getattr(_BUF_POOL, name, None)
+    if (buf is None) or (buf.size < size):
+        buf = np.empty(size)
+        setattr(_BUF_POOL, name, buf)
+    return buf[:size]
+
+def _offsets(effective_area, ns):
+    '''
+    Returns the offsets of the Q = ns x ns points of the small grid
+    over the effective_area, relative to its center. The result is
+    memoized, so the returned arrays must not be modified.
+    
+    input
+    effective_area: tuple - x and y dimensions (in microns) of the area.
+    ns: int - number of points along the x- and y-axis.
+    
+    output
+    
+    ox, oy: numpy arrays 1D - x and y offsets (in meters) of the Q points.
+    '''
+    
+    key = (float(effective_area[0]), float(effective_area[1]), int(ns))
+    if key in _OFFSETS:
+        return _OFFSETS[key]
+    
+    assert (effective_area[0] > 0) and (effective_area[1] > 0), \
+    'effective area must be positive'
+    
+    assert ns%2 != 0, 'ns must be odd'
+        
+    dx = 0.000001*effective_area[0]/ns
+    dy = 0.000001*effective_area[1]/ns
+    
+    ns2 = int(ns//2)
+    
+    off_x = dx*np.arange(-ns2, ns2+1)
+    off_y = dy*np.arange(-ns2, ns2+1)
+    ox, oy = np.meshgrid(off_x, off_y)
+    
+    _OFFSETS[key] = (ox.ravel(), oy.ravel())
+    return _OFFSETS[key]
+
+def point2grid(x, y, effective_area, ns, z = None, out = None):
     '''
     Creates a regular grid of Qx x Qy points
     over the effective_area centered at each point
@@ -25,6 +87,8 @@ def point2grid(x, y, effective_area, ns, z = None):
     effective_area: tuple - x and y dimensions (in microns) of the area.
     ns: int - number of points along the x- and y-axis.
     y: numpy array 1D - y coordinates of the points (in meters) - default is None.
+    out: None or list of numpy arrays 1D - if not None, arrays with Q*x.size
+         elements in which xgrid, ygrid (and zgrid) are stored.
     
     output
     
@@ -33,44 +97,399 @@ def point2grid(x, y, effective_area, ns, z = None):
     zgrid: numpy array 1D - z coordinates of the grid (in meters).
     '''
     
-    assert (effective_area[0] > 0) and (effective_area[1] > 0), \
-    'effective area must be positive'
-        
     assert x.size == y.size, 'x and y must have the same number of elements'
     
     if z is not None:
         assert x.size == z.size, 'x, y and z must have the same number of elements'
     
-    assert ns%2 != 0, 'ns must be odd'
+    ox, oy = _offsets(effective_area, ns)
+    Q = ox.size
+
+    if out is None:
+        out = [np.empty(Q*x.size) for i in range(2 if z is None else 3)]
+    else:
+        # reshape would copy a non-contiguous array and lose the result
+        assert len(out) >= (2 if z is None else 3), 'out must have one array per grid'
+        for grid in out[:(2 if z is None else 3)]:
+            assert grid.flags.c_contiguous and (grid.size == Q*x.size), \
+                   'out arrays must be contiguous with Q*x.size elements'
+
+    # each row i holds the Q points of the small grid centered at (x[i],y[i])
+    xgrid = out[0]
+    ygrid = out[1]
+    np.add(np.asarray(x, dtype=np.float64)[:,None], ox[None,:], out=xgrid.reshape(x.size, Q))
+    np.add(np.asarray(y, dtype=np.float64)[:,None], oy[None,:], out=ygrid.reshape(x.size, Q))
+
+    if z is not None:
+        zgrid = out[2]
+        zgrid.reshape(x.size, Q)[:] = np.asarray(z, dtype=np.float64)[:,None]
+
+    if z is not None:
+        return xgrid, ygrid, zgrid
+    else:
+        return xgrid, ygrid
+
+# Numba versions of the Fatiando a Terra prism and sphere kernels.
+# The field is averaged over the small grid of offsets (ox, oy) inside the
+# loop, so the Q x N expanded coordinates are never built.
+# The kernels have explicit float64 signatures, so they are compiled when this
+# module is imported and cached on disk for the next sessions. Their float32
+# versions are compiled on the first call with precision='fp32' (see _kernel),
+# as are the helpers, which have no signatures and are compiled for the types
+# of the kernels that call them. The arguments of the kernels must be
+# contiguous float64 (or float32) arrays and int alpha. Each prism kernel is
+# the difference between the sums over the 4 corners of its faces x2 and x1.
+# In float32, the square roots, logarithms and arctangents are evaluated in
+# single precision, while the sums over the corners, the difference between
+# the faces and the sums over the prisms and points are kept in double
+# precision and the output is float64.
+
+# maximum size of the tiles (number of data x number of prisms) used by fill_G
+BLOCK_DATA = 1024
+BLOCK_PRISMS = 8
+
+# number of data whose expanded grids are built at a time by the Fatiando a
+# Terra fallback
+BLOCK_GRID = 1024
+
+if njit is not None:
+
+    @njit(cache=True)
+    def _safe_atan2(y, x):
+        if y == 0:
+            return 0.
+        if (y > 0) and (x < 0):
+            return math.atan2(y, x) - math.pi
+        if (y < 0) and (x < 0):
+            return math.atan2(y, x) + math.pi
+        return math.atan2(y, x)
+
+    @njit(cache=True)
+    def _safe_log(x):
+        if x == 0:
+            return 0.
+        return math.log(x)
+
+    @njit(cache=True)
+    def _face_kernels(dx, yp, zp, p, alpha):
+        # p = (x1, x2, y1, y2, z1, z2, ...)
+        # returns the sums over the 4 corners of the face of the prism at the
+        # distance dx along x of the kernels xz, yz and zz (alpha = 0 or 2) or
+        # xy, yy and yz (alpha = 1 or 3), which share the distances to the corners
+        v1 = 0.
+        v2 = 0.
+        v3 = 0.
+        for k in range(2):
+            dz = p[5 - k] - zp
+            for j in range(2):
+                dy = p[3 - j] - yp
+                r = math.sqrt(dx*dx + dy*dy + dz*dz)
+                if (alpha == 0) or (alpha == 2):
+                    k1 = _safe_log(dy + r)
+                    k2 = _safe_log(dx + r)
+                    k3 = -_safe_atan2(dx*dy, dz*r)
+                else:
+                    k1 = _safe_log(dz + r)
+                    k2 = -_safe_atan2(dz*dx, dy*r)
+                    k3 = _safe_log(dx + r)
+                if (j + k)%2 == 0:
+                    v1 += k1
+                    v2 += k2
+                    v3 += k3
+                else:
+                    v1 -= k1
+                    v2 -= k2
+                    v3 -= k3
+        return v1, v2, v3
+
+    @njit(cache=True)
+    def _shares_face(prisms, p):
+        # True if the face x1 of the prism p is the face x2 of the prism p - 1,
+        # as for the juxtaposed prisms created by sample
+        return ((p > 0) and (prisms[p,0] == prisms[p-1,1]) and
+                (prisms[p,2] == prisms[p-1,2]) and (prisms[p,3] == prisms[p-1,3]) and
+                (prisms[p,4] == prisms[p-1,4]) and (prisms[p,5] == prisms[p-1,5]))
+
+    @njit('void(f8[::1],f8[::1],f8[::1],f8[::1],f8[::1],f8[:,::1],i8,f8[::1])',
+          parallel=True, fastmath=True, nogil=True, cache=True)
+    def avg_field(x, y, z, ox, oy, prisms, alpha, out):
+        '''
+        Adds to out the component of the magnetic induction (in nT)
+        produced by the prisms, averaged over the points (x + ox, y + oy, z).
         
-    dx = 0.000001*effective_area[0]/ns
-    dy = 0.000001*effective_area[1]/ns
+        prisms: numpy array 2D - one row (x1, x2, y1, y2, z1, z2, mx, my, mz)
+                per prism.
+        alpha: int - index of the plane (bz for 0 and 2, by for 1 and 3).
+        '''
+        Q = ox.size
+        for i in prange(x.size):
+            s = 0.
+            for q in range(Q):
+                xp = x[i] + ox[q]
+                yp = y[i] + oy[q]
+                # each prism is the difference between its faces x2 and x1;
+                # a face shared with the previous prism is evaluated once
+                f1, f2, f3 = 0., 0., 0.
+                for p in range(prisms.shape[0]):
+                    if _shares_face(prisms, p):
+                        l1, l2, l3 = f1, f2, f3
+                    else:
+                        l1, l2, l3 = _face_kernels(prisms[p,0] - xp, yp, z[i], prisms[p], alpha)
+                    f1, f2, f3 = _face_kernels(prisms[p,1] - xp, yp, z[i], prisms[p], alpha)
+                    s += prisms[p,6]*(f1 - l1) + prisms[p,7]*(f2 - l2) + prisms[p,8]*(f3 - l3)
+            out[i] += CM*T2NT*s/Q
+
+    @njit('void(f8[::1],f8[::1],f8[::1],f8[::1],f8[::1],f8[:,::1],i8,f8[::1])',
+          parallel=True, fastmath=True, nogil=True, cache=True)
+    def avg_field_spheres(x, y, z, ox, oy, spheres, alpha, out):
+        '''
+        Adds to out the component of the magnetic induction (in nT)
+        produced by the spheres, averaged over the points (x + ox, y + oy, z).
+        
+        spheres: numpy array 2D - one row (x, y, z, radius, mx, my, mz)
+                 per sphere.
+        alpha: int - index of the plane (bz for 0 and 2, by for 1 and 3).
+        '''
+        Q = ox.size
+        for i in prange(x.size):
+            s = 0.
+            for q in range(Q):
+                for p in range(spheres.shape[0]):
+                    dx = spheres[p,0] - x[i] - ox[q]
+                    dy = spheres[p,1] - y[i] - oy[q]
+                    dz = spheres[p,2] - z[i]
+                    r2 = dx*dx + dy*dy + dz*dz
+                    r5 = r2*r2*math.sqrt(r2)
+                    volume = 4.*math.pi*spheres[p,3]**3/3.
+                    if (alpha == 0) or (alpha == 2):
+                        s += volume*(spheres[p,4]*3*dx*dz + spheres[p,5]*3*dy*dz +
+                                     spheres[p,6]*(3*dz*dz - r2))/r5
+                    else:
+                        s += volume*(spheres[p,4]*3*dx*dy + spheres[p,5]*(3*dy*dy - r2) +
+                                     spheres[p,6]*3*dy*dz)/r5
+            out[i] += CM*T2NT*s/Q
+
+    @njit('void(f8[::1],f8[::1],f8[::1],f8[::1],f8[::1],f8[:,::1],i8,f8,i8,f8[::1,:])',
+          parallel=True, fastmath=True, nogil=True, cache=True)
+    def fill_G(x, y, z, ox, oy, prisms, alpha, scale, block, G):
+        '''
+        Stores in the columns 3p, 3p+1 and 3p+2 of G the kernels of the
+        prism p multiplying mx, my and mz, averaged over the points
+        (x + ox, y + oy, z) and multiplied by scale.
+        
+        G is filled by tiles of block data x BLOCK_PRISMS prisms, so the
+        coordinates of a tile are reused by all of its prisms, and the face
+        shared by two juxtaposed prisms of a tile is evaluated once. G must be
+        in Fortran order: the kernels of a tile are buffered and written to G
+        one column at a time, with unit stride.
+        '''
+        N = x.size
+        P = prisms.shape[0]
+        Q = ox.size
+        c = scale/Q
+        nbn = (N + block - 1)//block
+        nbp = (P + BLOCK_PRISMS - 1)//BLOCK_PRISMS
+        for t in prange(nbn*nbp):
+            n0 = (t//nbp)*block
+            n1 = min(n0 + block, N)
+            p0 = (t%nbp)*BLOCK_PRISMS
+            p1 = min(p0 + BLOCK_PRISMS, P)
+            acc = np.empty((p1 - p0, 3))
+            tile = np.empty((3*(p1 - p0), n1 - n0))
+            for i in range(n0, n1):
+                acc[:] = 0.
+                for q in range(Q):
+                    xp = x[i] + ox[q]
+                    yp = y[i] + oy[q]
+                    f1, f2, f3 = 0., 0., 0.
+                    for p in range(p0, p1):
+                        if (p > p0) and _shares_face(prisms, p):
+                            l1, l2, l3 = f1, f2, f3
+                        else:
+                            l1, l2, l3 = _face_kernels(prisms[p,0] - xp, yp, z[i],
+                                                       prisms[p], alpha)
+                        f1, f2, f3 = _face_kernels(prisms[p,1] - xp, yp, z[i],
+                                                   prisms[p], alpha)
+                        acc[p-p0,0] += f1 - l1
+                        acc[p-p0,1] += f2 - l2
+                        acc[p-p0,2] += f3 - l3
+                for p in range(p0, p1):
+                    tile[3*(p-p0),i-n0] = acc[p-p0,0]
+                    tile[3*(p-p0)+1,i-n0] = acc[p-p0,1]
+                    tile[3*(p-p0)+2,i-n0] = acc[p-p0,2]
+            for k in range(3*(p1 - p0)):
+                for i in range(n0, n1):
+                    G[i,3*p0+k] = c*tile[k,i-n0]
+
+    @njit('void(f8[::1])', parallel=True, cache=True)
+    def _start_threads(out):
+        # the Numba thread pool, and so its threading layer, is started by
+        # the first parallel kernel
+        for i in prange(out.size):
+            out[i] = i
+
+    @njit('UniTuple(f8,2)(f8[::1],f8[::1],f8[::1])',
+          parallel=True, fastmath=True, nogil=True, error_model='numpy',
+          cache=True)
+    def _znorm(do, dp, out):
+        '''
+        Stores in out the normalized residuals do - dp and returns their mean
+        and standard deviation, reading do and dp twice instead of four times.
+        '''
+        n = do.size
+        # shifting by the first residual avoids cancellation in ss/n - d*d
+        shift = do[0] - dp[0]
+        s = 0.
+        ss = 0.
+        for i in prange(n):
+            d = do[i] - dp[i] - shift
+            s += d
+            ss += d*d
+        d = s/n
+        mean = shift + d
+        std = math.sqrt(max(ss/n - d*d, 0.))
+        inv = 1./std
+        for i in prange(n):
+            out[i] = (do[i] - dp[i] - mean)*inv
+        return mean, std
+
+def _tile_rows(N, P):
+    '''
+    Returns the number of data of the tiles used by fill_G to fill the
+    sensitivity matrix of N data and P prisms. The tiles have at most
+    BLOCK_DATA data, and there are enough of them to give each Numba thread
+    about 4 tiles, so the load stays balanced on machines with many cores.
+    '''
     
-    ns2 = int(ns//2)
-    Q = int(ns*ns)
+    # numba.get_num_threads is missing before Numba 0.49
+    try:
+        from numba import get_num_threads
+        threads = get_num_threads()
+    except ImportError:
+        threads = numba_config.NUMBA_NUM_THREADS
     
-    x_small_grid, y_small_grid = np.meshgrid(dx*np.arange(-ns2, ns2+1), dy*np.arange(-ns2, ns2+1))
+    nbp = (P + BLOCK_PRISMS - 1)//BLOCK_PRISMS
+    nbn = max((N + BLOCK_DATA - 1)//BLOCK_DATA, min(N, (4*threads + nbp - 1)//nbp), 1)
+    return max((N + nbn - 1)//nbn, 1)
+
+# float32 versions of the Numba kernels, compiled on their first use by _kernel
+_FP32_KERNELS = {}
+_FP32_LOCK = threading.Lock()
+
+def _kernel(kernel, dtype):
+    '''
+    Returns the Numba kernel (avg_field, avg_field_spheres or fill_G) for
+    arrays of the given dtype. The float32 version is compiled on its first
+    use, so importing this module only compiles the float64 kernels.
+    '''
     
-    #print x_small_grid
-    #print y_small_grid
+    if dtype == np.float64:
+        return kernel
     
-    xgrid = np.resize(x, Q*x.size).reshape(Q,x.size).T.ravel()
-    ygrid = np.resize(y, Q*y.size).reshape(Q,y.size).T.ravel()
+    with _FP32_LOCK:
+        if kernel not in _FP32_KERNELS:
+            _FP32_KERNELS[kernel] = njit(parallel=True, fastmath=True, nogil=True,
+                                         cache=True)(kernel.py_func)
+        return _FP32_KERNELS[kernel]
+
+def meshers_to_soa(model, columns = None):
+    '''
+    Converts a list of geometrical elements of the Fatiando a Terra
+    class mesher to a numpy array 2D with one row per element.
     
-    if z is not None:
-        zgrid = np.resize(z, Q*z.size).reshape(Q,z.size).T.ravel()
+    input
     
-    for i, xi in enumerate(x):
-        xgrid[i*Q:(i+1)*Q] += x_small_grid.ravel()
-    for i, yi in enumerate(y):
-        ygrid[i*Q:(i+1)*Q] += y_small_grid.ravel()
-        
-    if z is not None:
-        return xgrid, ygrid, zgrid
+    model: list - rectangular prisms or spheres of the mesher class.
+           If it is already a numpy array 2D, it is returned as a
+           contiguous float64 array. Elements that are None are
+           skipped, as in Fatiando a Terra.
+    columns: None or int - if not None, the number of columns that the
+             array must have (9 for prisms and 7 for spheres).
+    
+    output
+    
+    params: numpy array 2D - rows (x1, x2, y1, y2, z1, z2, mx, my, mz) for
+            prisms or (x, y, z, radius, mx, my, mz) for spheres. The
+            magnetization (in A/m) is zero for elements without it.
+    '''
+    
+    if isinstance(model, np.ndarray):
+        params = np.ascontiguousarray(model, dtype=np.float64)
+        assert (columns is None) or ((params.ndim == 2) and (params.shape[1] == columns)), \
+               'expected a numpy array 2D with %s columns' % columns
+        return params
+    
+    model = [e for e in model if e is not None]
+    if (len(model) == 0) and (columns is not None):
+        return np.zeros((0, columns))
+    if (len(model) > 0) and isinstance(model[0], mesher.Sphere):
+        params = np.zeros((len(model), 7))
+        for i, g in enumerate(model):
+            params[i,:4] = g.x, g.y, g.z, g.radius
+            if 'magnetization' in g.props:
+                params[i,4:] = g.props['magnetization']
     else:
-        return xgrid, ygrid
+        params = np.zeros((len(model), 9))
+        for i, p in enumerate(model):
+            params[i,:6] = p.x1, p.x2, p.y1, p.y2, p.z1, p.z2
+            if 'magnetization' in p.props:
+                params[i,6:] = p.props['magnetization']
+    
+    assert (columns is None) or (params.shape[1] == columns), \
+           'expected a list of %s' % ('prisms' if columns == 9 else 'spheres')
+    return params
 
-def magnetic_data(x, y, z, model, alpha, eff_area = None, grains = None):
+def soa_to_meshers(params):
+    '''
+    Converts a numpy array 2D returned by meshers_to_soa back to a list of
+    geometrical elements of the Fatiando a Terra class mesher.
+    
+    input
+    
+    params: numpy array 2D - rows (x1, x2, y1, y2, z1, z2, mx, my, mz) for
+            prisms or (x, y, z, radius, mx, my, mz) for spheres.
+            If it is not a numpy array, it is returned unchanged.
+    
+    output
+    
+    model: list - rectangular prisms or spheres of the mesher class.
+    '''
+    
+    if not isinstance(params, np.ndarray):
+        return params
+    
+    if params.shape[1] == 7:
+        return [mesher.Sphere(g[0], g[1], g[2], g[3], {'magnetization': g[4:]})
+                for g in params]
+    return [mesher.Prism(p[0], p[1], p[2], p[3], p[4], p[5], {'magnetization': p[6:]})
+            for p in params]
+
+def _kernel_inputs(x, y, z, eff_area, precision):
+    '''
+    Returns x, y, z and the offsets (ox, oy) of the points on which the field is
+    averaged within the effective area of the sensor (a single point if eff_area
+    is None) as contiguous arrays with the precision ('fp32' or 'fp64') used by
+    the Numba kernels.
+    '''
+    
+    assert (precision == 'fp32') or (precision == 'fp64'), \
+           "precision must be 'fp32' or 'fp64'"
+    
+    # the Numba kernels do not check bounds, so y[i] and z[i] must exist
+    assert (np.size(x) == np.size(y)) and (np.size(x) == np.size(z)), \
+           'x, y and z must have the same number of elements'
+    
+    dtype = np.float32 if precision == 'fp32' else np.float64
+    
+    if eff_area is None:
+        ox, oy = np.zeros(1), np.zeros(1)
+    else:
+        ox, oy = _offsets(eff_area, 7)
+    
+    return [np.ascontiguousarray(a, dtype=dtype) for a in (x, y, z, ox, oy)]
+
+def magnetic_data(x, y, z, model, alpha, eff_area = None, grains = None,
+                  precision = 'fp64', out = None):
     '''
     Calculates the magnetic indution on the plane alpha
     located around the sample.
@@ -80,9 +499,12 @@ def magnetic_data(x, y, z, model, alpha, eff_area = None, grains = None):
     x, y, z: numpy arrays - Cartesian coordinates (in m) of 
              the points on which the magnetic field is calculated.
     model: list - geometrical elements of the Fatiando a Terra 
-           class mesher - interpretation model.
+           class mesher - interpretation model. It can also be
+           the numpy array 2D returned by sample(..., soa=True).
     grains: None or list - if not None, is a list of geometrical elements 
             of the Fatiando a Terra class mesher - randomly magnetized grains.
+            It can also be the numpy array 2D returned by
+            dipolesrand(..., soa=True).
     alpha: int - index of the plane on which the data are calculated.
     eff_area: None or tuple of floats - effective area of the simulated sensor.
               If None, calculates the field at the points x, y, z.
@@ -95,30 +517,71 @@ def magnetic_data(x, y, z, model, alpha, eff_area = None, grains = None):
         If effe_area is not None, ns = (nsx,nsy), where nsx and nsy are
         the number of points on which the filed is averaged within the
         the effective area of the sensor along the x and y axes.
+    precision: string - 'fp64' or 'fp32', floating point precision of the
+               Numba kernels. 'fp32' is only about 10% faster, since the
+               sums are kept in double precision, and its kernels are
+               compiled on the first call. The Fatiando a Terra
+               kernels, used if Numba is not installed, are always 'fp64'.
+    out: None or numpy array - if not None, a float64 array with x.size
+         elements in which the data are stored, e.g., to reuse it across
+         the iterations of an inversion.
     
     output
     
-    B: numpy array - magnetic data
+    B: numpy array - magnetic data (out, if it is not None)
     '''
     
     assert (alpha == 0) or (alpha == 1) or (alpha == 2) or (alpha == 3), \
            'alpha must be equal to 0, 1, 2 or 3'
+    
+    if out is not None:
+        assert (out.shape == (x.size,)) and (out.dtype == np.float64) and \
+               out.flags.c_contiguous, 'out must be a contiguous float64 array with x.size elements'
+    
+    if njit is not None:
+        
+        x, y, z, ox, oy = _kernel_inputs(x, y, z, eff_area, precision)
+        
+        prisms = np.ascontiguousarray(meshers_to_soa(model, 9), dtype=x.dtype)
+        
+        if out is None:
+            B = np.zeros(x.size)
+        else:
+            B = out
+            B[:] = 0.
+        _kernel(avg_field, x.dtype)(x, y, z, ox, oy, prisms, int(alpha), B)
+        if grains is not None:
+            spheres = np.ascontiguousarray(meshers_to_soa(grains, 7), dtype=x.dtype)
+            _kernel(avg_field_spheres, x.dtype)(x, y, z, ox, oy, spheres, int(alpha), B)
+        
+        return B
+    
+    model = soa_to_meshers(model)
+    grains = soa_to_meshers(grains)
            
     if eff_area is not None:
         
         ns = 7
         
-        xg, yg, zg = point2grid(x, y, eff_area, ns, z)
+        B = np.empty(x.size) if out is None else out
+        
+        # the grids are built for BLOCK_GRID points at a time to bound
+        # the memory used by the ns*ns expanded coordinates
+        grids = [_scratch(name, ns*ns*min(BLOCK_GRID, x.size)) for name in ('xg', 'yg', 'zg')]
+        for i0 in range(0, x.size, BLOCK_GRID):
+            i1 = min(i0 + BLOCK_GRID, x.size)
+            xg, yg, zg = point2grid(x[i0:i1], y[i0:i1], eff_area, ns, z[i0:i1],
+                                    [g[:ns*ns*(i1-i0)] for g in grids])
             
-        if (alpha == 0) or (alpha == 2):
-            B = np.mean(np.reshape(prism.bz(xg, yg, zg, model), (x.size, ns*ns)), axis=1)
-            if grains is not None:
-                B += np.mean(np.reshape(sphere.bz(xg, yg, zg, grains), (x.size, ns*ns)), axis=1)
+            if (alpha == 0) or (alpha == 2):
+                B[i0:i1] = np.mean(np.reshape(prism.bz(xg, yg, zg, model), (i1-i0, ns*ns)), axis=1)
+                if grains is not None:
+                    B[i0:i1] += np.mean(np.reshape(sphere.bz(xg, yg, zg, grains), (i1-i0, ns*ns)), axis=1)
 
-        if (alpha == 1) or (alpha == 3):
-            B = np.mean(np.reshape(prism.by(xg, yg, zg, model), (x.size, ns*ns)), axis=1)
-            if grains is not None:
-                B += np.mean(np.reshape(sphere.by(xg, yg, zg, grains), (x.size, ns*ns)), axis=1)
+            if (alpha == 1) or (alpha == 3):
+                B[i0:i1] = np.mean(np.reshape(prism.by(xg, yg, zg, model), (i1-i0, ns*ns)), axis=1)
+                if grains is not None:
+                    B[i0:i1] += np.mean(np.reshape(sphere.by(xg, yg, zg, grains), (i1-i0, ns*ns)), axis=1)
         
     else:
         if (alpha == 0) or (alpha == 2):
@@ -129,10 +592,13 @@ def magnetic_data(x, y, z, model, alpha, eff_area = None, grains = None):
             B = prism.by(x, y, z, model)
             if grains is not None:
                 B += sphere.by(x, y, z, grains)
+        if out is not None:
+            out[:] = B
+            B = out
 
     return B
 
-def sample(Lx,Ly,Lz,P,m=None,inc=None,dec=None):
+def sample(Lx,Ly,Lz,P,m=None,inc=None,dec=None,soa=False):
     '''
     Define the interpretation model as a 1D array of rectangular prisms
     along the x-axis.
@@ -151,6 +617,9 @@ def sample(Lx,Ly,Lz,P,m=None,inc=None,dec=None):
     inc: list - magnetization inclination (graus) of each prism.
     dec: list - magnetization declination (graus) of each prism.
     
+    soa: boolean - if True, returns the model as a numpy array 2D
+         (see meshers_to_soa) instead of a list of prisms.
+    
     output
     
     model: list of geometrical elements mesher class of the 
@@ -164,32 +633,31 @@ def sample(Lx,Ly,Lz,P,m=None,inc=None,dec=None):
     L = P*sizex
     a = -0.5*L
     
-    model = []
-
-    if ((m is not None) & (inc is not None) & (dec is not None)):
-        intensity = np.array(m)
-        inclinacao = np.array(inc)
-        declinacao = np.array(dec)
-        mag = []
-        for i in range(P):
-            mag.append(ang2vec(intensity[i],inclinacao[i],declinacao[i]))
-    
-        for i in range(P):
-            model.append(mesher.Prism(a+i*sizex, a+(i+1)*sizex, \
-                                      -0.5*sizey, 0.5*sizey, \
-                                      -0.5*sizez, 0.5*sizez, \
-                                      {'magnetization': mag[i]}))
-    else:
-        for i in range(P):
-            model.append(mesher.Prism(a+i*sizex, a+(i+1)*sizex, \
-                                      -0.5*sizey, 0.5*sizey, \
-                                      -0.5*sizez, 0.5*sizez))
-        
-    return model
+    prisms = np.zeros((P, 9))
+    prisms[:,0] = a + np.arange(P)*sizex
+    prisms[:,1] = a + np.arange(1, P+1)*sizex
+    prisms[:,2] = -0.5*sizey
+    prisms[:,3] = 0.5*sizey
+    prisms[:,4] = -0.5*sizez
+    prisms[:,5] = 0.5*sizez
 
+    magnetized = (m is not None) & (inc is not None) & (dec is not None)
+    if magnetized:
+        intensity = np.array(m, dtype=np.float64)
+        inclinacao = np.array(inc, dtype=np.float64)
+        declinacao = np.array(dec, dtype=np.float64)
+        prisms[:,6:] = ang2vec(intensity[:P],inclinacao[:P],declinacao[:P])
+    
+    if soa:
+        return prisms
+    
+    if not magnetized:
+        return [mesher.Prism(*p[:6]) for p in prisms]
+    return soa_to_meshers(prisms)
 
 
-def sensitivity(P,x,y,z,model,alpha, eff_area = None):
+
+def sensitivity(P,x,y,z,model,alpha, eff_area = None, precision = 'fp64', G_out = None):
     '''
     Calculates the Jacobian matrix of the inversion
     
@@ -204,34 +672,71 @@ def sensitivity(P,x,y,z,model,alpha, eff_area = None):
     z: list - coordinates z (in meters)
     model: list - Geometrical elements of the mesher class
         of the Fatiando a Terra package - interpretation model.
+        It can also be the numpy array 2D returned by sample(..., soa=True).
+    
+    precision: string - 'fp64' or 'fp32', floating point precision of the
+        Numba kernels. 'fp32' is only about 10% faster, since the sums are
+        kept in double precision, and its kernels are compiled on the first
+        call. The Fatiando a Terra kernels, used if Numba is not installed,
+        are always 'fp64'.
+    
+    G_out: None or matrix - if not None, a float64 array with shape
+        (x.size, 3*P) in Fortran order in which G is stored.
     
     G: matrix with number of rows equal to the number N of data and 
        number of colunms equal to the number M of parameters.
         
     '''
     
-    G = np.empty((x.size, 3*P))
+    # column-major, since G is filled one column (parameter) at a time
+    if G_out is None:
+        G = np.empty((x.size, 3*P), order='F')
+    else:
+        assert (G_out.shape == (x.size, 3*P)) and (G_out.dtype == np.float64) and \
+               G_out.flags.f_contiguous, 'G_out must be a float64 array (x.size, 3*P) in Fortran order'
+        G = G_out
     
     cols = np.reshape(np.arange(3*P), (P, 3))
     
+    if njit is not None:
+        
+        x, y, z, ox, oy = _kernel_inputs(x, y, z, eff_area, precision)
+        
+        prisms = np.ascontiguousarray(meshers_to_soa(model, 9), dtype=x.dtype)
+        assert prisms.shape[0] >= P, 'model must have at least P prisms'
+        
+        # as in the Fatiando a Terra path, only the first P prisms are used
+        _kernel(fill_G, x.dtype)(x, y, z, ox, oy, prisms[:P], int(alpha), CM*T2NT,
+                                 _tile_rows(x.size, P), G)
+        
+        return G
+        
     if eff_area is not None:
     
+        model = soa_to_meshers(model)
         ns = 7
         Q = ns*ns
         
-        xg, yg, zg = point2grid(x, y, eff_area, ns, z)
-        
-        for i, col in enumerate(cols):
-            if (alpha == 0 or alpha == 2):
-                G[:,col[0]] = np.mean(np.reshape(prism.kernelxz(xg, yg, zg, model[i]), (x.size, Q)), axis=1)
-                G[:,col[1]] = np.mean(np.reshape(prism.kernelyz(xg, yg, zg, model[i]), (x.size, Q)), axis=1)
-                G[:,col[2]] = np.mean(np.reshape(prism.kernelzz(xg, yg, zg, model[i]), (x.size, Q)), axis=1)
-            if (alpha == 1 or alpha == 3):
-                G[:,col[0]] = np.mean(np.reshape(prism.kernelxy(xg, yg, zg, model[i]), (x.size, Q)), axis=1)
-                G[:,col[1]] = np.mean(np.reshape(prism.kernelyy(xg, yg, zg, model[i]), (x.size, Q)), axis=1)
-                G[:,col[2]] = np.mean(np.reshape(prism.kernelyz(xg, yg, zg, model[i]), (x.size, Q)), axis=1)
+        # the grids are built for BLOCK_GRID points at a time to bound
+        # the memory used by the Q expanded coordinates
+        grids = [_scratch(name, Q*min(BLOCK_GRID, x.size)) for name in ('xg', 'yg', 'zg')]
+        for i0 in range(0, x.size, BLOCK_GRID):
+            i1 = min(i0 + BLOCK_GRID, x.size)
+            xg, yg, zg = point2grid(x[i0:i1], y[i0:i1], eff_area, ns, z[i0:i1],
+                                    [g[:Q*(i1-i0)] for g in grids])
+            
+            for i, col in enumerate(cols):
+                if (alpha == 0 or alpha == 2):
+                    G[i0:i1,col[0]] = np.mean(np.reshape(prism.kernelxz(xg, yg, zg, model[i]), (i1-i0, Q)), axis=1)
+                    G[i0:i1,col[1]] = np.mean(np.reshape(prism.kernelyz(xg, yg, zg, model[i]), (i1-i0, Q)), axis=1)
+                    G[i0:i1,col[2]] = np.mean(np.reshape(prism.kernelzz(xg, yg, zg, model[i]), (i1-i0, Q)), axis=1)
+                if (alpha == 1 or alpha == 3):
+                    G[i0:i1,col[0]] = np.mean(np.reshape(prism.kernelxy(xg, yg, zg, model[i]), (i1-i0, Q)), axis=1)
+                    G[i0:i1,col[1]] = np.mean(np.reshape(prism.kernelyy(xg, yg, zg, model[i]), (i1-i0, Q)), axis=1)
+                    G[i0:i1,col[2]] = np.mean(np.reshape(prism.kernelyz(xg, yg, zg, model[i]), (i1-i0, Q)), axis=1)
                 
     else:
+        model = soa_to_meshers(model)
         for i, col in enumerate(cols):
             if (alpha == 0 or alpha == 2):
                 G[:,col[0]] = prism.kernelxz(x, y, z, model[i])
@@ -245,6 +750,88 @@ def sensitivity(P,x,y,z,model,alpha, eff_area = None):
     G *= CM*T2NT
     return G
 
+def _plane_workers(n):
+    '''
+    Returns the number of threads used to process n observation planes.
+    '''
+    
+    if njit is not None:
+        # the workqueue layer cannot run parallel kernels called from
+        # several threads at once, so the planes run one by one with it
+        try:
+            layer = threading_layer()
+        except ValueError:
+            _start_threads(np.empty(2))
+            layer = threading_layer()
+        if layer == 'workqueue':
+            return 1
+    return max(n, 1)
+
+def compute_all_planes(x_list, y_list, z_list, model, eff_area = None, grains = None,
+                       precision = 'fp64'):
+    '''
+    Calculates the magnetic indution on the observation planes
+    located around the sample, one plane per thread.
+    
+    input
+    
+    x_list, y_list, z_list: lists of numpy arrays - Cartesian coordinates
+                            (in m) of the points on the planes alpha = 0, 1, ...
+    model, eff_area, grains, precision: see magnetic_data.
+    
+    output
+    
+    B: list of numpy arrays - magnetic data on each plane
+    '''
+    
+    assert len(x_list) == len(y_list) == len(z_list), \
+           'x_list, y_list and z_list must have the same number of planes'
+    
+    # on Python 2.7, concurrent.futures is the futures backport
+    from concurrent.futures import ThreadPoolExecutor
+    
+    n = len(x_list)
+    with ThreadPoolExecutor(max_workers=_plane_workers(n)) as executor:
+        futures = [executor.submit(magnetic_data, x_list[alpha], y_list[alpha], z_list[alpha],
+                                   model, alpha, eff_area, grains, precision)
+                   for alpha in range(n)]
+        B = [future.result() for future in futures]
+    
+    return B
+
+def sensitivity_all_planes(P, x_list, y_list, z_list, model, eff_area = None,
+                           precision = 'fp64'):
+    '''
+    Calculates the Jacobian matrices of the observation planes
+    located around the sample, one plane per thread.
+    
+    input
+    
+    P: int - number of prisms
+    x_list, y_list, z_list: lists of numpy arrays - Cartesian coordinates
+                            (in m) of the points on the planes alpha = 0, 1, ...
+    model, eff_area, precision: see sensitivity.
+    
+    output
+    
+    G: list of matrices - Jacobian matrix of each plane
+    '''
+    
+    assert len(x_list) == len(y_list) == len(z_list), \
+           'x_list, y_list and z_list must have the same number of planes'
+    
+    # on Python 2.7, concurrent.futures is the futures backport
+    from concurrent.futures import ThreadPoolExecutor
+    
+    n = len(x_list)
+    with ThreadPoolExecutor(max_workers=_plane_workers(n)) as executor:
+        futures = [executor.submit(sensitivity, P, x_list[alpha], y_list[alpha], z_list[alpha],
+                                   model, alpha, eff_area, precision)
+                   for alpha in range(n)]
+        G = [future.result() for future in futures]
+    
+    return G
+
 def parameters_sph(N,coord):
     '''
     Makes the transformation from Cartesian Coordinates to Intensity, Declination
@@ -259,23 +846,18 @@ def parameters_sph(N,coord):
     return
     
     mag_sph: array - Matrix with shape (N x 3) containing each row with the values of 
-    intensity, declination and inclination.
+    intensity, inclination and declination.
     '''
     
-    mag_cart = []
-    for i in range(N):
-        mag_cart.append(np.array([coord[3*i],coord[3*i+1],coord[3*i+2]]))
-        
-        
-    mag_spheric = []
-    for i in range(N):
-        aux = vec2ang(mag_cart[i])
-        if (aux[2] > 180.):
-            aux[2] -= 360.
-        if (aux[2] <= -180.):
-            aux[2] += 360.
-        mag_spheric.append(aux)
-    mag_sph = np.array(mag_spheric)
+    mag_cart = np.reshape(np.asarray(coord, dtype=np.float64)[:3*N], (N, 3))
+    
+    intensity = np.linalg.norm(mag_cart, axis=1)
+    inc = np.rad2deg(np.arcsin(mag_cart[:,2]/intensity))
+    dec = np.rad2deg(np.arctan2(mag_cart[:,1], mag_cart[:,0]))
+    dec = np.where(dec > 180., dec - 360., dec)
+    dec = np.where(dec <= -180., dec + 360., dec)
+    
+    mag_sph = np.stack([intensity, inc, dec], axis=1)
     return mag_sph
 
 
@@ -299,19 +881,19 @@ def proj_polar(N,mag,color='k',simbolo='o',size=10):
     
     '''
        
-    projections = []
-    for i in range(N):
-        projections.append(np.sqrt((np.cos(np.deg2rad(mag[i,1]))*np.cos(np.deg2rad(mag[i,2])))**2 +(np.cos(np.deg2rad(mag[i,1]))*np.sin(np.deg2rad(mag[i,2])))**2))
-        proj = np.array(projections)
-    for i in range(N):
-        if mag[i,1] >= 0.0:
-            mpl.plot(np.deg2rad(mag[i,2]), proj[i], marker=simbolo, ms=size,mec= color, mew=3, mfc= color, fillstyle='full')
-        else:
-            mpl.plot(np.deg2rad(mag[i,2]), proj[i], marker=simbolo, ms=size, mec= color, mew=3, fillstyle='none') 
+    inc = np.deg2rad(mag[:N,1])
+    dec = np.deg2rad(mag[:N,2])
+    # norm of the horizontal projection of the unit vector
+    proj = np.abs(np.cos(inc))
+    
+    # positive inclinations are plotted with filled markers
+    mask = mag[:N,1] >= 0.0
+    mpl.plot(dec[mask], proj[mask], linestyle='none', marker=simbolo, ms=size, mec= color, mew=3, mfc= color, fillstyle='full')
+    mpl.plot(dec[~mask], proj[~mask], linestyle='none', marker=simbolo, ms=size, mec= color, mew=3, fillstyle='none')
 
 
 
-def dipolesrand(N, seed,n,deg_dec,deg_inc,std,mag,raio,Lx,Ly,Lz):
+def dipolesrand(N, seed,n,deg_dec,deg_inc,std,mag,raio,Lx,Ly,Lz,soa=False):
     '''
     Generates a set of spheres randomly distribuited within the model
     
@@ -335,6 +917,9 @@ def dipolesrand(N, seed,n,deg_dec,deg_inc,std,mag,raio,Lx,Ly,Lz):
     
     Lx,Ly,Lz: int - prisms dimensions (m)
     
+    soa: boolean - if True, returns the spheres as a numpy array 2D
+         (see meshers_to_soa) instead of a list.
+    
     return
     
     modelrand: list of geometrical objects using the library Fatiando a Terra.
@@ -351,13 +936,17 @@ def dipolesrand(N, seed,n,deg_dec,deg_inc,std,mag,raio,Lx,Ly,Lz):
     Dec_rand = np.random.normal(deg_dec, std,n)
     Inc_rand = np.random.normal(deg_inc, std,n)
     
-    magrand = []
-    for i in range(n):
-        magrand.append(ang2vec(mag,Inc_rand[i],Dec_rand[i]))
+    spheres = np.zeros((n, 7))
+    spheres[:,0] = Coordx
+    spheres[:,1] = Coordy
+    spheres[:,2] = Coordz
+    spheres[:,3] = R
+    spheres[:,4:] = ang2vec(mag,Inc_rand,Dec_rand)
     
-    modelrand = []
-    for i in range(n):
-        modelrand.append(mesher.Sphere(Coordx[i], Coordy[i], Coordz[i], R , {'magnetization': magrand[i]})) 
+    if soa:
+        return spheres,Coordx,Coordy,Coordz
+    
+    modelrand = soa_to_meshers(spheres)
 
     return modelrand,Coordx,Coordy,Coordz
 
@@ -379,6 +968,16 @@ def residual(do,dp):
 
     r_std : float - standard deviation of the residuals
     '''
+    # the Numba kernel only takes two non-empty vectors of the same size;
+    # other shapes keep the numpy broadcasting below
+    if (njit is not None) and (np.ndim(do) == 1) and (np.shape(do) == np.shape(dp)) \
+       and (np.size(do) > 0):
+        do = np.ascontiguousarray(do, dtype=np.float64)
+        dp = np.ascontiguousarray(dp, dtype=np.float64)
+        r_norm = np.empty(do.size)
+        r_mean, r_std = _znorm(do, dp, r_norm)
+        return r_norm, r_mean, r_std
+    
     r = do - dp
     r_mean = np.mean(r)
     r_std = np.std(r)
@@ -429,16 +1028,13 @@ def coordplane(h,L,Nx,Ny,area,alpha,theta):
     if (alpha == 3):
         x, z, y = gridder.regular(areaxy, shape, -voo)
     
-    x_rot = []
-    y_rot = []
-    z_rot = []
     if (alpha==0 or alpha ==2):
-        x_rot.append(cos*x - sin*y)
-        y_rot.append(sin*x + cos*y)
-        z_rot.append(z)
+        x_rot = cos*x - sin*y
+        y_rot = sin*x + cos*y
+        z_rot = z
     if (alpha == 1 or alpha == 3):
-        x_rot.append(cos*x - sin*z)
-        z_rot.append(sin*x + cos*z)
-        y_rot.append(y)
+        x_rot = cos*x - sin*z
+        z_rot = sin*x + cos*z
+        y_rot = y
     
-    return x_rot[0], y_rot[0], z_rot[0]
\ No newline at end of file
+    return x_rot, y_rot, z_rot
\ No newline at end of file